@@ -0,0 +1,29 @@
+import os
+
+# Settings shared by manual_update_firmware.py, manual_update_firmware_win.py and get_debug_logs.py
+
+BAUDRATE = 9600
+WINDOWS = os.name == 'nt'
+SERIAL_STARTER_DIR = "/opt/victronenergy/serial-starter"
+MODULE_M_USB_ID = (0x239A, 0x80A4)  # (vid, pid) the Module M enumerates with
+
+UF2_TIMEOUT = 20  # seconds
+UF2_FLASH_RETRIES = 3  # number of times to retry firmware upload
+UF2_FLASH_RETRY_DELAY = 5  # maximum seconds to wait before retrying a firmware upload
+UF2_FILENAME = "firmware.uf2"  # name of the firmware file written to the UF2 drive
+UF2_BLOCK_SIZE = 512  # bytes per block in a uf2 file
+UF2_MAGIC_START = b"UF2\n\x57\x51\x5d\x9e"  # first 8 bytes of every uf2 block, the magics 0x0A324655 and 0x9E5D5157
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # bytes per chunk when downloading the firmware, most uf2 files arrive in one or two
+UF2_WRITE_SIZE = 64 * 1024  # bytes per write to the UF2 drive, a multiple of the 4096 byte FAT cluster
+DOWNLOAD_RETRIES = 3  # number of times to retry a failed or 5xx download request
+DRIVE_RECHECK_INTERVAL = 5  # seconds between drive label checks when no device event arrives
+NETLINK_KOBJECT_UEVENT = 15  # netlink protocol on which the kernel and udev broadcast device events (Linux only)
+UDEV_CONTROL = "/run/udev/control"  # exists while udevd runs (Linux only)
+UF2_LABEL = "ENERTYMBOOT"  # filesystem label of the ESP32's UF2 drive
+DISK_BY_LABEL_DIR = "/dev/disk/by-label"  # udev symlinks named after the filesystem label (Linux only)
+
+BOOT_COMMAND_TIMEOUT = 5  # seconds to wait for response
+BOOT_COMMAND_RETRY_DELAY = 3  # maximum seconds to wait before retrying
+RETRY_BACKOFF_START = 0.25  # seconds to wait before the first retry, doubled for every next retry
+MAX_BOOT_RETRIES = 5  # maximum number of retries for boot command
+MAX_FIRMWARE_RETRIES = 3  # maximum number of retries for firmware version check
@@ -0,0 +1,487 @@
+# Functions shared by manual_update_firmware.py, manual_update_firmware_win.py, get_debug_logs.py and send_debug_command.py
+
+import os
+import re
+import time
+import select
+import socket
+import struct
+import random
+import subprocess
+import contextlib
+import ctypes
+import threading
+from config import (BAUDRATE, WINDOWS, SERIAL_STARTER_DIR, UF2_BLOCK_SIZE, UF2_MAGIC_START,
+                    DOWNLOAD_CHUNK_SIZE, DOWNLOAD_RETRIES, NETLINK_KOBJECT_UEVENT, UDEV_CONTROL, UF2_LABEL,
+                    DISK_BY_LABEL_DIR, MODULE_M_USB_ID, BOOT_COMMAND_TIMEOUT, BOOT_COMMAND_RETRY_DELAY,
+                    RETRY_BACKOFF_START, MAX_BOOT_RETRIES, MAX_FIRMWARE_RETRIES, UF2_TIMEOUT, UF2_WRITE_SIZE,
+                    DRIVE_RECHECK_INTERVAL)
+
+LIBC = None if WINDOWS else ctypes.CDLL(None, use_errno=True)  # for mount(2)/umount2(2) without spawning mount/umount
+SUDO = [] if WINDOWS or os.geteuid() == 0 else ['sudo']  # prefix for commands that need root, empty when already root (Linux only)
+BLKID_CACHE = {}  # label -> (mtime of /dev, device path) of the last blkid lookup (Linux only)
+VOLUME_LABEL_CACHE = {}  # (drive letters bitmask, drive path) -> volume label (Windows only)
+DRIVE_REMOVABLE = 2  # GetDriveTypeW result for a removable drive such as the UF2 drive (Windows only)
+MAX_VOLUME_LABEL = 32  # characters in a volume label at most (Windows only)
+MS_NOATIME = 1024  # mount(2) flag, don't write access times to the drive (Linux only)
+ESPRESSIF_USB_VID = 0x303A  # USB vendor id of the ESP32-S2's native USB port (Windows only)
+USB_SERIAL_IDS = {(0x1A86, 0x7523), (0x10C4, 0xEA60), (0x0403, 0x6001)}  # (vid, pid) of CH340, CP210x and FTDI converters (Windows only)
+USB_SERIAL_DESCRIPTIONS = ("USB-SERIAL CH340", "CP210X", "USB SERIAL DEVICE", "UART")  # upper case port description hints, UART is a generic check (Windows only)
+
+def retry_delay(attempt, start=RETRY_BACKOFF_START, cap=BOOT_COMMAND_RETRY_DELAY):
+    """Seconds to wait after a failed attempt: doubles from start up to cap, plus up to start of jitter."""
+    return min(start * 2 ** attempt, cap) + random.uniform(0, start)
+
+def is_uf2(firmware):
+    """Check that every 512 byte block starts with the UF2 magic, an HTML error page or a cut off download does not."""
+    if not firmware or len(firmware) % UF2_BLOCK_SIZE:
+        return False
+    return all(firmware.startswith(UF2_MAGIC_START, offset) for offset in range(0, len(firmware), UF2_BLOCK_SIZE))
+
+def parse_firmware_version(text):
+    """Extract a version like 2.0.6 from a version string or a file name such as flash_esp32s2_V2.0.6.uf2."""
+    match = re.search(r'(\d+)\.(\d+)\.(\d+)', text or "")
+    return tuple(int(part) for part in match.groups()) if match else None
+
+def list_serial_ports():
+    """List the /dev/ttyACM ports, lowest number first."""
+    # Sort on the number, as strings ttyACM10 would come before ttyACM2
+    ports = (name for name in os.listdir('/dev') if name.startswith('ttyACM') and name[len('ttyACM'):].isdigit())
+    return [f"/dev/{name}" for name in sorted(ports, key=lambda name: int(name[len('ttyACM'):]))]
+
+def find_serial_port(indent=""):
+    """Find the ESP32's serial port, on Linux the first /dev/ttyACM port."""
+    if WINDOWS:
+        import serial.tools.list_ports # Windows serial port listing, imported here as Linux never needs it
+        ports = serial.tools.list_ports.comports()
+        if not ports:
+            print(f"[!]{indent} No serial ports found.")
+            raise IndexError("No serial ports found")
+        
+        # Match the Module M on its own USB ids first, so an unrelated converter on another port never wins over it
+        for p in ports:
+            if (p.vid, p.pid) == MODULE_M_USB_ID:
+                print(f"[+]{indent} Selected serial port: {p.device} - {p.description}")
+                return p.device
+
+        # Fall back on the ESP32's native USB port or a common USB-to-Serial converter, a cheap integer compare per port
+        for p in ports:
+            if p.vid == ESPRESSIF_USB_VID or (p.vid, p.pid) in USB_SERIAL_IDS:
+                print(f"[+]{indent} Selected serial port: {p.device} - {p.description}")
+                return p.device
+
+        # Fall back on the description for converters not in USB_SERIAL_IDS
+        # You might need to adjust these strings based on your specific ESP32 board
+        for p in ports:
+            description = p.description.upper()
+            if any(hint in description for hint in USB_SERIAL_DESCRIPTIONS):
+                print(f"[+]{indent} Selected serial port: {p.device}")
+                return p.device
+        
+        print(f"[!]{indent} No suitable ESP32 serial port found. Listing all available ports:")
+        for p in ports:
+            print(f"    {p.device} - {p.description}")
+        raise IndexError("No suitable ESP32 serial port found")
+
+    ports = list_serial_ports()
+    if not ports:
+        print(f"[!]{indent} No /dev/ttyACM* devices found.")
+        raise IndexError("No serial ports found")
+    return ports[0]
+
+def run_serial_starter_script(script, port_name, indent=""):
+    """Run a Victron serial-starter script for a port. Returns True if it succeeded."""
+    try:
+        # This script is specific to Victron VenusOS
+        result = subprocess.run([f"{SERIAL_STARTER_DIR}/{script}", port_name], capture_output=True)
+    except FileNotFoundError:
+        print(f"[*]{indent} The serial starter script {script} does not exist. Skipping.")
+        return False
+    if result.returncode != 0:
+        print(f"[!]{indent} Serial starter script {script} failed with return code: {result.returncode}")
+        return False
+    return True
+
+@contextlib.contextmanager
+def serial_starter_paused(port_name, indent="", restart_on_success=True):
+    """Stop the Victron serial-starter for a port while the with block runs. Runs without sudo.
+    With restart_on_success=False it is only started again when the block is left through an exception or exit(),
+    the updaters use that so a port that went into the bootloader is left alone once its UF2 drive is there."""
+    if WINDOWS:
+        yield
+        return
+    port_name = os.path.basename(port_name) # just in case we send dev/port_name
+    stopped = run_serial_starter_script("stop-tty.sh", port_name, indent)
+    try:
+        yield
+    except BaseException:
+        if stopped:
+            run_serial_starter_script("start-tty.sh", port_name, indent)
+        raise
+    if stopped and restart_on_success:
+        run_serial_starter_script("start-tty.sh", port_name, indent)
+
+def open_serial_port(serial_port, indent=""):
+    """Open the ESP32 serial port. Returns None if it could not be opened."""
+    # serial is only imported on the paths that talk to the ESP32, a device already in UF2 mode loads it after flashing
+    import serial
+    try:
+        # The port timeout bounds each read_until/readline on the replies
+        ser = serial.Serial(serial_port, BAUDRATE, timeout=BOOT_COMMAND_TIMEOUT)
+    except serial.SerialException as e:
+        print(f"[!]{indent} Could not open {serial_port}: {e}")
+        return None
+    try:
+        # Ask the driver to hand over bytes immediately instead of on its latency tick (Linux only, not every driver supports it)
+        ser.set_low_latency_mode(True)
+    except (AttributeError, ValueError, OSError):
+        pass
+    return ser
+
+def send_command(ser, command, max_retries, read_response, indent=""):
+    """Write a debug command on an open port and let read_response(ser, indent) handle the reply, with retry logic.
+    Returns the first result that is not None, or None when all attempts failed."""
+    import serial
+    for attempt in range(max_retries):
+        try:
+            ser.reset_input_buffer()
+            print(f"[*]{indent} Attempt {attempt + 1}/{max_retries}: Sending '{command.decode()}' to ESP32...")
+            ser.write(command)
+            result = read_response(ser, indent)
+            if result is not None:
+                return result
+        except serial.SerialException as e:
+            print(f"[!]{indent} Serial error on attempt {attempt + 1}: {e}")
+        
+        if attempt < max_retries - 1:
+            # Back off from a short first wait, a device that was just busy answers the next attempt
+            delay = retry_delay(attempt)
+            print(f"[*]{indent} Waiting {delay:.1f} seconds before retry...")
+            time.sleep(delay)
+    return None
+
+def read_boot_confirmation(ser, indent=""):
+    """Wait for the reply to '$D'. Returns True when the bootloader is triggered, None to retry."""
+    # Both outcomes end the wait straight away: the confirmation ends the read, a reboot into the bootloader
+    # removes the port which makes the read raise. Otherwise the port timeout ends it.
+    try:
+        response = ser.read_until(b"Triggering bootloader")
+    except OSError:
+        print(f"[*]{indent} Serial connection disconnected, bootloader trigger is likely successful.")
+        return True
+    if response.strip():
+        print(f"[*]{indent} Received: {response.decode('utf-8', errors='ignore').strip()}")
+    if b"Triggering bootloader" in response:
+        print(f"[+]{indent} Bootloader trigger confirmed!")
+        return True
+    print(f"[!]{indent} No response or incorrect response received.")
+    return None
+
+def read_firmware_version(ser, indent=""):
+    """Wait for the reply to '$K'. Returns the version string, False when the device went away, None to retry."""
+    # Block until the confirmation arrives or the port timeout passes, the version is on the line after it
+    try:
+        response = ser.read_until(b"recieved debug command")
+        if b"recieved debug command" in response:
+            ser.readline()  # rest of the confirmation line
+            version = ser.readline().decode('utf-8', errors='ignore').strip()
+            if version:
+                print(f"[+]{indent} Firmware version: {version}")
+                return version
+    except OSError as e:
+        print(f"[*]{indent} Serial connection disconnected ({e})")
+        return False
+    if response.strip():
+        print(f"[*]{indent} Received: {' '.join(response.decode('utf-8', errors='ignore').split())}")
+    return None
+
+def send_boot_command(ser, indent=""):
+    """Send boot command on an open port and verify response with retry logic."""
+    if send_command(ser, b'$D', MAX_BOOT_RETRIES, read_boot_confirmation, indent):
+        return True
+    print(f"[!]{indent} Failed to trigger bootloader after {MAX_BOOT_RETRIES} attempts.")
+    return False
+
+def get_firmware_version(ser, indent=""):
+    """Send version command '$K' on an open port and parse the response with retry logic."""
+    version = send_command(ser, b'$K', MAX_FIRMWARE_RETRIES, read_firmware_version, indent)
+    if not version:
+        print(f"[!]{indent} Failed to get firmware version after {MAX_FIRMWARE_RETRIES} attempts.")
+        return None
+    return version
+
+def get_drive_label_windows(drive_path):
+    """
+    On Windows, get the volume label of a drive letter with GetVolumeInformationW, in process instead of starting powershell.
+    Returns None if label not found or error.
+    """
+    label = ctypes.create_unicode_buffer(MAX_VOLUME_LABEL + 1)
+    if not ctypes.windll.kernel32.GetVolumeInformationW(drive_path, label, len(label), None, None, None, None, 0):
+        return None
+    return label.value
+
+def check_for_drive_label(target_label=UF2_LABEL, indent=""):
+    """
+    Check if a device with the specified label is present.
+    Returns device path (e.g., '/dev/sdb1' or 'D:\\') if found, None otherwise.
+    """
+    if WINDOWS:
+        import string
+        kernel32 = ctypes.windll.kernel32
+        drives = kernel32.GetLogicalDrives()  # bit 0 is A:, bit 1 is B: and so on
+        # Only read the label of removable drives, the UF2 drive is one and fixed, network and cd drives are skipped
+        for i, letter in enumerate(string.ascii_uppercase):
+            drive_path = f"{letter}:\\"
+            if drives >> i & 1 and kernel32.GetDriveTypeW(drive_path) == DRIVE_REMOVABLE:
+                # A label read before is reused while no drive letter came or went, failed reads are tried again next time
+                label = VOLUME_LABEL_CACHE.get((drives, drive_path))
+                if label is None:
+                    label = get_drive_label_windows(drive_path)
+                    if label is not None:
+                        VOLUME_LABEL_CACHE[(drives, drive_path)] = label
+                if label and label.upper() == target_label.upper():
+                    print(f"[*]{indent} Found drive '{drive_path}' with label '{label}'")
+                    return drive_path
+        return None
+
+    # udev keeps a symlink per filesystem label, reading it needs no sudo or blkid
+    label_link = os.path.join(DISK_BY_LABEL_DIR, target_label)
+    if os.path.exists(label_link):
+        return os.path.realpath(label_link)
+
+    # Without the udev link (e.g. only the FAT boot sector carries the label) ask blkid.
+    # blkid probes every block device, so it is only run again when a node in /dev was added or removed since the last run
+    dev_mtime = os.stat('/dev').st_mtime_ns
+    cached = BLKID_CACHE.get(target_label)
+    if cached and cached[0] == dev_mtime:
+        return cached[1]
+    try:
+        device_path = find_label_with_blkid(target_label)
+    except FileNotFoundError:
+        print(f"[!]{indent} 'blkid' command not found. Is it installed and in your PATH?")
+        return None
+    except subprocess.CalledProcessError as e:
+        print(f"[!]{indent} Error running blkid: {e.stderr.strip()}")
+        return None
+    except Exception as e:
+        print(f"[!]{indent} Error parsing blkid output: {e}")
+        return None
+    # Only a clean "no match" is cached, a failed run is tried again on the next check
+    BLKID_CACHE[target_label] = (dev_mtime, device_path)
+    return device_path
+
+def find_label_with_blkid(target_label):
+    """Return the device with the label according to blkid, or None (Linux only)."""
+    # Let blkid filter on the label and print only the device name, the boot sector label is tried on a miss
+    for tag in ('LABEL', 'LABEL_FATBOOT'):
+        result = subprocess.run(SUDO + ['blkid', '-o', 'device', '-t', f'{tag}={target_label}'],
+                                capture_output=True, text=True)
+        # blkid exits with 2 when no device matches, anything else non-zero is a real error
+        if result.returncode == 0 and result.stdout.strip():
+            return result.stdout.split('\n', 1)[0].strip()
+        if result.returncode not in (0, 2):
+            raise subprocess.CalledProcessError(result.returncode, result.args, result.stdout, result.stderr)
+    return None
+
+def wait_for_usb_drive(indent=""):
+    """Wait for the ESP32's UF2 USB drive to appear. Returns its device path, or None after UF2_TIMEOUT."""
+    print(f"[*]{indent} Waiting for ESP32 USB drive to appear...")
+    monitor = open_device_monitor(indent=indent)
+    try:
+        deadline = time.monotonic() + UF2_TIMEOUT
+        # Check once first as the drive may already be there, then take it from the udev event or check again on any other event
+        device_path = check_for_drive_label(indent=indent)
+        poll_delay = 0.05  # without device events (always on Windows) check often at first, backing off to once a second
+        while not device_path and time.monotonic() < deadline:
+            timeout = min(DRIVE_RECHECK_INTERVAL, deadline - time.monotonic())
+            device_path = wait_for_device_event(monitor, timeout, label=UF2_LABEL, poll_delay=poll_delay)
+            device_path = device_path or check_for_drive_label(indent=indent)
+            poll_delay = min(poll_delay * 1.5, 1.0)
+        if device_path:
+            print(f"[+]{indent} Found USB drive at {str(device_path).strip()}")
+            return device_path
+    finally:
+        if monitor is not None:
+            monitor.close()
+    return None
+
+def wait_for_drive_to_disappear(device_path, indent=""):
+    """Wait for the UF2 drive to disappear after flashing."""
+    print(f"[*]{indent} Waiting for ESP32 to reboot and drive to disappear...")
+    monitor = open_device_monitor(indent=indent)
+    try:
+        deadline = time.monotonic() + UF2_TIMEOUT
+        poll_delay = 0.05  # without device events (always on Windows) check often at first, backing off to once a second
+        while time.monotonic() < deadline:
+            # The device node (or drive letter) going away is enough, that check needs no blkid
+            current_device = check_for_drive_label(indent=indent) if os.path.exists(device_path) else None
+            if not current_device or current_device.upper() != device_path.upper():
+                print(f"[+]{indent} Drive disappeared. Update likely successful.")
+                return True
+            wait_for_device_event(monitor, min(DRIVE_RECHECK_INTERVAL, deadline - time.monotonic()), poll_delay=poll_delay)
+            poll_delay = min(poll_delay * 1.5, 1.0)
+    finally:
+        if monitor is not None:
+            monitor.close()
+    print(f"[!]{indent} Drive did not disappear in time.")
+    return False
+
+def write_firmware_file(firmware, dest_path, indent=""):
+    """Write the firmware to dest_path on the mounted drive and flush only that file (Linux only)."""
+    written = False
+    try:
+        # Unbuffered writes so the data goes straight to the drive without an extra copy in a BufferedWriter
+        fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            # The firmware only exists in memory, a memoryview slice is written without copying it first. This is the
+            # one copy into the kernel, sendfile would need the firmware in a source file which costs a write of its own.
+            data = memoryview(firmware)
+            while data:
+                data = data[os.write(fd, data[:UF2_WRITE_SIZE]):]
+            written = True
+            # Only the data and the file size matter to the bootloader, skip flushing the timestamps
+            os.fdatasync(fd)
+            # The synced pages are of no use to us anymore, let the kernel drop them from the page cache
+            with contextlib.suppress(OSError):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+        print(f"[+]{indent} Firmware copied and synced successfully.")
+        return True
+    except OSError as e:
+        if written:
+            # The bootloader reboots as soon as the last block lands, so the drive can vanish while syncing
+            print(f"[*]{indent} Drive went away while syncing ({e}), the device is likely rebooting.")
+            return True
+        print(f"[!]{indent} Failed to copy or sync firmware: {e}")
+        return False
+
+def convert_to_raw_url(github_url):
+    """Converts a GitHub blob URL to a raw content URL."""
+    if "github.com" in github_url and "/blob/" in github_url:
+        raw_url = github_url.replace("github.com", "raw.githubusercontent.com").replace("/blob/", "/")
+        print(f"[*] Converted GitHub URL to raw content URL: {raw_url}")
+        return raw_url
+    return github_url
+
+def open_device_monitor(indent=""):
+    """Subscribe to kernel device events. Returns None on Windows or if not supported, callers then fall back to polling."""
+    if WINDOWS:
+        return None
+    try:
+        monitor = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        # Listen to udev while it runs (group 2), its events come after the by-label links are made and carry the
+        # filesystem label. The kernel's own events (group 1) come before udev has looked at the device.
+        monitor.bind((0, 2 if os.path.exists(UDEV_CONTROL) else 1))
+        return monitor
+    except (AttributeError, OSError) as e:
+        print(f"[*]{indent} Device events not available ({e}), polling instead.")
+        return None
+
+def wait_for_device_event(monitor, timeout, label=None, poll_delay=1):
+    """Block until a block device is added or removed or timeout seconds have passed, without a monitor sleep poll_delay.
+    Returns the device path when udev reports an added device with the given filesystem label."""
+    deadline = time.monotonic() + max(timeout, 0)
+    if monitor is None:
+        time.sleep(min(max(timeout, 0), poll_delay))
+        return None
+    while True:
+        ready, _, _ = select.select([monitor], [], [], max(deadline - time.monotonic(), 0))
+        if not ready:
+            return None
+        block_event = False
+        while True:
+            try:
+                event = monitor.recv(8192, socket.MSG_DONTWAIT)  # drain, a burst of events needs only one label check
+            except BlockingIOError:
+                break
+            # Kernel events start with 'action@devpath' followed by KEY=value fields. udev events start with a binary
+            # header instead, the offset of their KEY=value fields is at byte 16 of it.
+            if event.startswith(b"libudev\0"):
+                properties_off = struct.unpack_from("=I", event, 16)[0]
+                event = event[properties_off:]
+            fields = event.split(b"\0")
+            if b"SUBSYSTEM=block" not in fields:
+                continue
+            if b"ACTION=add" in fields and label and f"ID_FS_LABEL={label}".encode() in fields:
+                for field in fields:
+                    if field.startswith(b"DEVNAME="):
+                        return os.path.join("/dev", field[len(b"DEVNAME="):].decode())  # udev gives the full path
+            if b"ACTION=add" in fields or b"ACTION=remove" in fields:
+                block_event = True
+        if block_event:
+            return None
+
+def libc_call(name, *args):
+    """Call a libc function that returns 0 on success, raise OSError when it fails (Linux only)."""
+    if getattr(LIBC, name)(*args) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+def download_firmware(github_url):
+    """Download firmware from a given URL. The firmware is kept in memory, returns its bytes or None on failure."""
+    print(f"[*] Downloading firmware from {github_url}...")
+    try:
+        # requests is slow to import, doing it here keeps --help fast and lets the import run in the download thread.
+        # A missing install fails the download like any other error, before the bootloader is triggered.
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        # This is the only HTTP request of a run, so one session here is all the sharing there is: it keeps the
+        # connection alive across a github redirect and the retries. requests already asks for gzip by default.
+        with requests.Session() as session:
+            retry = Retry(total=DOWNLOAD_RETRIES, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+            session.mount('https://', HTTPAdapter(max_retries=retry))
+            with session.get(github_url, stream=True, timeout=(5, 30)) as r:
+                r.raise_for_status()
+                firmware = bytearray()
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    firmware += chunk
+        # The bootloader ignores a file that is not uf2 and the drive never goes away, catch that before flashing
+        if not is_uf2(firmware):
+            print(f"[!] The downloaded file is not a uf2 firmware ({len(firmware)} bytes), check the link.")
+            return None
+        print(f"[+] Firmware downloaded ({len(firmware)} bytes)")
+        return bytes(firmware)
+    except ImportError as e:
+        print(f"[!] Cannot download firmware, requests is not installed: {e}")
+        return None
+    except requests.exceptions.RequestException as e:
+        print(f"[!] Failed to download firmware: {e}")
+        return None
+    except Exception as e:
+        print(f"[!] An unexpected error occurred during download: {e}")
+        return None
+
+class FirmwareDownload(threading.Thread):
+    """Runs download_firmware on a daemon thread. Executor threads are joined at exit, so an early exit (already up
+    to date, no ESP32 found) would still wait for a slow download to finish."""
+
+    def __init__(self, github_url):
+        super().__init__(daemon=True)
+        self.github_url = github_url
+        self.firmware = None
+        self.error = None  # whatever escaped download_firmware, main reports it
+
+    def run(self):
+        try:
+            self.firmware = download_firmware(self.github_url)
+        except BaseException as e:
+            self.error = e
+
+    def done(self):
+        return not self.is_alive()
+
+    def result(self):
+        """Wait for the download. Returns the firmware bytes or None, raises what escaped download_firmware."""
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.firmware
+
+def start_firmware_download(github_url):
+    """Start downloading the firmware in the background. Returns the FirmwareDownload."""
+    download = FirmwareDownload(github_url)
+    download.start()
+    return download
@@ -1,6 +1,7 @@
 import sys
-import os
 import logging
+import subprocess
+import select
 import time
 from module_m_decoder import ModuleM
 
@@ -13,12 +14,24 @@ def update():
     if module_m._read_data() and module_m._decode_data():
         pass
 
+def wait_for_data(timeout=1.0):
+    """Block until the Module M serial port has data to read, or timeout seconds have passed."""
+    ser = module_m.ser
+    if ser is None or not ser.is_open:
+        time.sleep(timeout) # no port yet, _read_data will search for it on the next update
+        return
+    select.select([ser.fileno()], [], [], timeout)
+
 
 def update_from_github():
     logging.info("updating gridconnection_watcher.py")
-    os.system("sudo git reset --hard")
-    os.system("sudo git pull")
-    os.system("sudo systemctl restart gridconnection_watcher.service")
+    # Run the commands directly instead of through a shell, and stop at the first one that fails
+    try:
+        subprocess.run(["sudo", "git", "reset", "--hard"], check=True)
+        subprocess.run(["sudo", "git", "pull"], check=True)
+        subprocess.run(["sudo", "systemctl", "restart", "gridconnection_watcher.service"], check=True)
+    except (subprocess.CalledProcessError, FileNotFoundError) as e:
+        logging.error(f"update failed: {e}")
 
 
 
@@ -29,4 +42,4 @@ if __name__ == "__main__":
     
     while True:
         update()
-        time.sleep(0.3)
\ No newline at end of file
+        wait_for_data()
\ No newline at end of file
@@ -42,6 +42,7 @@ cat <<EOL > $SERVICE_FILE_PATH
 [Unit]
 Description=gridconnection watcher
 After=network.target
+StartLimitIntervalSec=0
 
 [Service]
 Type=simple
@@ -49,6 +50,7 @@ WorkingDirectory=$SCRIPT_DIR
 ExecStart=$PYTHON_EXEC $SCRIPT_DIR/gridconnection_watcher.py
 KillSignal=SIGINT
 Restart=on-failure
+RestartSec=5s
 User=$CURRENT_USER
 
 [Install]
@@ -1,16 +1,17 @@
-import copy
 import select
 import struct
 import logging
 import socket
 import sys
+import threading
 import time
 import serial
 import serial.tools.list_ports
 import subprocess
+from config import MODULE_M_USB_ID
 
-VID = 0x239A
-PID = 0x80A4
+VID, PID = MODULE_M_USB_ID
+PORT_SEARCH_INTERVAL = 2 # seconds between background searches for the Module M serial port while it is not connected
 
 # Open the serial port
 WINDOWS = sys.platform.startswith('win')
@@ -33,6 +34,10 @@ WINDOWS = sys.platform.startswith('win')
     };"""
 
 class VictronSerialAmpsAndVoltage:
+    # fixed set of fields, slots keep them out of a per instance __dict__
+    __slots__ = ('command', 'export_CT1', 'export_CT2', 'export_CT3', 'I1', 'I2', 'I3', 'U1', 'U2', 'U3',
+                 'P1', 'P2', 'P3', 'energy_forward', 'energy_reverse')
+
     def __init__(self) -> None:
         self.command: int = 0
         self.export_CT1: bool = False
@@ -52,30 +57,33 @@ class VictronSerialAmpsAndVoltage:
         
     
     def set_all_to_zero(self):
-        self.I1 = 0
-        self.I2 = 0
-        self.I3 = 0
-        self.U1 = 0
-        self.U2 = 0
-        self.U3 = 0
-        self.P1 = 0
-        self.P2 = 0
-        self.P3 = 0
+        self.I1 = self.I2 = self.I3 = 0
+        self.U1 = self.U2 = self.U3 = 0
+        self.P1 = self.P2 = self.P3 = 0
+
+    @staticmethod
+    def _milli(value: int) -> str:
+        """Format an integer milli value with three decimals using integer math"""
+        whole, frac = divmod(abs(value), 1000)
+        return f"{'-' if value < 0 else ''}{whole}.{frac:03d}"
 
     def __str__(self) -> str:
-        return f"command: {self.command}, AC Phase L1: {self.U1 / 1000}V {self.I1 / 1000}A {self.P1 / 1000}W. AC Phase L2: {self.U2 / 1000}V {self.I2 / 1000}A {self.P2 / 1000}W. AC Phase L3: {self.U3 / 1000}V {self.I3 / 1000}A {self.P3 / 1000}W  -  ENERGY -> Forward: {self.energy_forward / 1000}kWh. Deverse: {self.energy_reverse / 1000}kWh"
+        m = self._milli
+        return f"command: {self.command}, AC Phase L1: {m(self.U1)}V {m(self.I1)}A {m(self.P1)}W. AC Phase L2: {m(self.U2)}V {m(self.I2)}A {m(self.P2)}W. AC Phase L3: {m(self.U3)}V {m(self.I3)}A {m(self.P3)}W  -  ENERGY -> Forward: {m(self.energy_forward)}kWh. Deverse: {m(self.energy_reverse)}kWh"
 
 
 class ModuleM:
 
     def __init__(self):
         self.ser = None
-        self.datagram = b""
+        self.datagram = bytearray() # received data that is not decoded yet, extended and consumed in place
         self.serialnumber = None
         self.mmdata = VictronSerialAmpsAndVoltage()
         self.mmregistered = False # module m registered with *B command
-        self.last_update = time.time()
-        self.mmregistered_last_register_request = time.time()
+        # monotonic clock, these are only compared against each other and must not jump with NTP
+        self.last_update = time.monotonic()
+        self.mmregistered_last_register_request = self.last_update
+        self.found_port = None # device path of Module M, set by the _scan_ports thread and taken by _connect
 
         # communication signals for dbus-homemanager
         self.new_port_name = False
@@ -83,44 +91,59 @@ class ModuleM:
         self.errors = []
         self.errors_show_index = 0 # the current displayed error in victron
 
+        # listing the ports reads sysfs for every serial device, do it on a thread so it never stalls the read loop
+        threading.Thread(target=self._scan_ports, daemon=True).start()
+
+    def _scan_ports(self):
+        """Look for Module M every PORT_SEARCH_INTERVAL seconds while its port is not open"""
+        while True:
+            if self.ser is None or not self.ser.is_open:
+                self.found_port = next((port.device for port in serial.tools.list_ports.comports()
+                                        if port.vid == VID and port.pid == PID), None)
+                if self.found_port is None:
+                    logging.info("Module M not found")
+            time.sleep(PORT_SEARCH_INTERVAL)
+
+    def _connect(self):
+        """Open the serial port the scanner found for Module M, returns True when the port is open"""
+        self.mmregistered = False
+        port, self.found_port = self.found_port, None
+        if port is None:
+            return False
+        try:
+            # serial.Serial opens the port right away when it is given one
+            self.ser = serial.Serial(port, 9600, timeout=0, rtscts=False, dsrdtr=False, xonxoff=False)
+        except serial.SerialException as e:
+            logging.error('Could not open serial port: %s', e.args[0])
+            return False
+        self.new_port_name = True
+        logging.info("Found Module M on %s", port)
+        return True
+
     def _read_data(self):
+        # check the port state instead of letting in_waiting raise on every call while there is no port
+        if (self.ser is None or not self.ser.is_open) and not self._connect():
+            return False
         try:
             in_waiting = self.ser.in_waiting
-            ready = in_waiting > 0
-        except Exception as e: # attribute error is thrown when no port passed to serial.Serial
+        except (OSError, serial.SerialException): # the device went away
             logging.info("Serial port closed")
             self.mmregistered = False
-            if self.ser is not None:
-                if self.ser.port is not None and self.ser.is_open:
-                    self.ser.close()
-            for port in serial.tools.list_ports.comports():
-                if port.vid == VID and port.pid == PID:
-                    port_name = port.name
-                    try:
-                        self.ser = serial.Serial(port_name, 9600, timeout=0, rtscts=False, dsrdtr=False, xonxoff=False)
-                    except serial.SerialException as e:
-                        logging.error(f'Could not open serial port: { e.args[0]}')
-                        return False
-                    self.new_port_name = True
-                    logging.info(f"Found Module M on {port_name}")
-                    self.ser.open()
-                    in_waiting = self.ser.in_waiting
-                    ready = in_waiting > 0
-                    break
-            else:
-                logging.info("Module M not found")
-                return False
+            self.ser.close()
+            return False
+        ready = in_waiting > 0
             
-        if not self.mmregistered and time.time() - self.mmregistered_last_register_request > 2:
-            self.mmregistered_last_register_request = time.time()
+        now = time.monotonic()
+        if not self.mmregistered and now - self.mmregistered_last_register_request > 2:
+            self.mmregistered_last_register_request = now
             logging.info("Registering Debug, sending $A")
             try:
                 self.ser.write(b'$A') # RegisterDebug_sendBackConfirmation
             except serial.SerialException as e:
-                logging.error(f'Could not write to serial port: { e.args[0]}')
+                logging.error('Could not write to serial port: %s', e.args[0])
             return False
 
-        if not ready and self.datagram == b'':
+        if not ready and not self.datagram:
             # logging.info('no data ready')
             return False
 
@@ -136,54 +159,65 @@ class ModuleM:
         try:
             self.ser.write(b'$D') # uf2 bootloader
         except serial.SerialException as e:
-            logging.error(f'Could not write to serial port: { e.args[0]}')
+            logging.error('Could not write to serial port: %s', e.args[0])
 
 
     def _decode_data(self):   
-        self.last_update = time.time()
+        self.last_update = time.monotonic()
 
         if not self.mmregistered:
             # search for the registration command inside the datagram
-            while len(self.datagram) > 2 and self.datagram[:2] != b'$B': # remove garbage data until we find RegisterVictronGXConfirmation
-                self.datagram = self.datagram[1:]
-
-            if len(self.datagram) >= 13:
-                self.mmregistered = True
-                self.datagram = self.datagram[2:13]
-                self.serialnumber = copy.deepcopy(self.datagram).decode('ascii')
-                self.new_serialnumber = True
-                self.datagram = b''
-                logging.info(f"Module M registered with serialnumber: {self.serialnumber}")
+            # remove garbage data until we find RegisterVictronGXConfirmation, find scans for it in C instead of a byte at a time
+            start = self.datagram.find(b'$B')
+            if start == -1:
+                # keep a trailing '$', it can be the start of a $B that is still arriving
+                end = len(self.datagram) - 1 if self.datagram.endswith(b'$') else len(self.datagram)
+                if end:
+                    logging.info('module m not registered, trowing away data: %r', bytes(self.datagram[:end]))
+                del self.datagram[:end]
                 return False
-            logging.info(f'module m not registered, trowing away data: {self.datagram}')
-            self.datagram = b""
+            del self.datagram[:start] # dropping the front of a bytearray does not copy the rest
+
+            # the reply can arrive in pieces, keep the partial $B frame until all 13 bytes are there
+            if len(self.datagram) < 13:
+                return False
+            self.mmregistered = True
+            self.serialnumber = self.datagram[2:13].decode('ascii')
+            self.new_serialnumber = True
+            self.datagram.clear()
+            logging.info("Module M registered with serialnumber: %s", self.serialnumber)
             return False
 
-        data = self.datagram.replace(b'\r', b'').split(b'\n')
-        for line in data:
-            logging.info(line.decode('ascii'))
-        self.datagram = b''
+        # decode once and let splitlines handle the \r\n endings, instead of a replace copy and a split
+        if logging.getLogger().isEnabledFor(logging.INFO): # the text is only logged, skip decoding it when INFO is filtered out
+            for line in self.datagram.decode('ascii').splitlines():
+                logging.info(line)
+        self.datagram.clear()
         return True
 
 if __name__ == "__main__":
-    start_time = time.time()
+    start_time = time.monotonic()
     send_uf2 = False
 
     logging.basicConfig(level=logging.INFO)
     sma = ModuleM()
     for port in serial.tools.list_ports.comports():
-            logging.info(f"{port.vid}, {port.pid}, desc: {port.name}")
+            logging.info("%s, %s, desc: %s", port.vid, port.pid, port.name)
     while True:
 
         if sma._read_data() and sma._decode_data():
             # logging.info(sma.mmdata)
-            # if start_time + 10 < time.time() and not send_uf2:
+            # if start_time + 10 < time.monotonic() and not send_uf2:
             #     sma.send_uf2_command()
             #     send_uf2 = True
             pass
         else:
-            if sma.last_update + 5 < time.time():
+            if sma.last_update + 5 < time.monotonic():
                 logging.info('not updated for 5 seconds')
                 sma.mmdata.set_all_to_zero()
-        time.sleep(1)
+        # wake up as soon as the port has data instead of sleeping a fixed second (select does not work on Windows serial ports)
+        if not WINDOWS and sma.ser is not None and sma.ser.is_open:
+            select.select([sma.ser.fileno()], [], [], 1)
+        else:
+            time.sleep(1)
     
\ No newline at end of file
@@ -5,9 +5,9 @@ ESP32 Debug Commander - Send debug commands to ESP32 from Raspberry Pi
 
 import serial
 import time
-import glob
 import sys
 from enum import IntEnum
+from esp32_utils import find_serial_port
 
 class DebugCommand(IntEnum):
     """Debug commands matching the ESP32 enum"""
@@ -25,14 +25,7 @@ class DebugCommand(IntEnum):
 
 # Magic start byte (you'll need to define this based on your ESP32 code)
 DEBUG_DEVICE_MAGIC_START = 0x24  # '$' - adjust this if different
-
-def find_serial_port(indent=""):
-    """Find the serial port for ESP32 communication"""
-    ports = glob.glob('/dev/ttyACM*')
-    if not ports:
-        print(f"[!]{indent} No /dev/ttyACM* devices found.")
-        raise IndexError("No serial ports found")
-    return ports[0]
+RESPONSE_LINE_GAP = 0.5  # seconds without a new line that end a response once it has started
 
 class ESP32DebugCommander:
     def __init__(self, port=None, baudrate=9600, timeout=2):
@@ -42,6 +35,7 @@ class ESP32DebugCommander:
         self.timeout = timeout
         self.serial_conn = None
         self.registered = False
+        self._tx = bytearray([DEBUG_DEVICE_MAGIC_START, 0, 0])  # command buffer reused by send_command
         
     def connect(self):
         """Connect to the ESP32"""
@@ -75,23 +69,23 @@ class ESP32DebugCommander:
             return False
         
         try:
-            # Prepare the message
-            message = bytearray([DEBUG_DEVICE_MAGIC_START, command])
+            # Prepare the message in the preallocated buffer, the magic start byte is already in place
+            self._tx[1] = command
+            length = 2
             
             # Add extra option if provided
             if extra_option is not None:
-                message.append(extra_option)
+                self._tx[2] = extra_option
+                length = 3
             
             # Send the command
-            self.serial_conn.write(message)
-            self.serial_conn.flush()
+            self.serial_conn.write(memoryview(self._tx)[:length])
             
             print(f"Sent command: 0x{command:02X}")
             if extra_option is not None:
                 print(f"With extra option: 0x{extra_option:02X}")
             
             # Wait for and read response
-            time.sleep(0.1)  # Give ESP32 time to process
             return self.read_response()
             
         except Exception as e:
@@ -103,19 +97,28 @@ class ESP32DebugCommander:
         if not self.serial_conn:
             return False
         
-        start_time = time.time()
+        deadline = time.monotonic() + timeout
         response_lines = []
         
-        while time.time() - start_time < timeout:
-            if self.serial_conn.in_waiting > 0:
-                try:
-                    line = self.serial_conn.readline().decode('utf-8', errors='ignore').strip()
-                    if line:
-                        print(f"ESP32: {line}")
-                        response_lines.append(line)
-                except Exception as e:
-                    print(f"Error reading response: {e}")
-            time.sleep(0.01)
+        try:
+            # Block in readline until a line arrives instead of polling in_waiting, the port timeout keeps it within the deadline
+            # once the response has started an empty read means the ESP32 is done, so don't wait out the whole deadline
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.serial_conn.timeout = min(remaining, RESPONSE_LINE_GAP) if response_lines else remaining
+                raw = self.serial_conn.readline()
+                if not raw and response_lines:
+                    break
+                line = raw.decode('utf-8', errors='ignore').strip()
+                if line:
+                    print(f"ESP32: {line}")
+                    response_lines.append(line)
+        except Exception as e:
+            print(f"Error reading response: {e}")
+        finally:
+            self.serial_conn.timeout = self.timeout
         
         return len(response_lines) > 0
     
@@ -171,7 +174,7 @@ class ESP32DebugCommander:
         
         print(f"Getting CT{ct_number} calibration table...")
         # Convert CT number to ASCII ('1', '2', '3')
-        ct_ascii = ord(str(ct_number))
+        ct_ascii = 0x30 + ct_number  # 0x30 is '0'
         return self.send_command(DebugCommand.GET_CT_CALIBRATION_TABLE, ct_ascii)
     
     def get_firmware_version(self):